@@ -10,8 +10,14 @@ from dotenv import load_dotenv
 from datetime import datetime, timezone
 import json
 import io
+import itertools
+import contextlib
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from werkzeug.utils import secure_filename
-from pdf2image import convert_from_bytes, pdfinfo_from_bytes
+from pdf2image import convert_from_path, pdfinfo_from_path
 from pdf2image.exceptions import (
     PDFInfoNotInstalledError,
     PDFPageCountError,
@@ -20,6 +26,11 @@ from pdf2image.exceptions import (
 )
 from PIL import Image
 
+try:
+    import fitz # PyMuPDF: rasterizes PDF pages in-process instead of spawning pdftoppm per page
+except ImportError:
+    fitz = None
+
 # --- Initial Setup ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 app_logger = logging.getLogger(__name__)
@@ -29,12 +40,33 @@ load_dotenv()
 app_logger.info(f"Flask app.py: .env loaded: {'Yes' if os.getenv('MONGODB_URI') else 'No (or MONGODB_URI not set)'}")
 
 # Use specific import for clarity
-from certificate_processor import infer_course_text_from_image_object, get_course_recommendations
+from certificate_processor import infer_course_text_from_image_objects, infer_course_text_from_image_regions, get_course_recommendations, warm_up_model, YOLO_BATCH_SIZE
 
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "*"}})
 app_logger.info("Flask app instance created with CORS enabled for all origins.")
 
+# Warm the YOLO model in the background so the first upload does not wait for it. Set YOLO_WARMUP_ON_START=0 to disable.
+# It must start in the process that serves requests: not at import, where the werkzeug reloader's parent or a
+# preloading server's master would load torch for nothing and could fork while the model is half loaded.
+_model_warm_up_started = False
+_model_warm_up_lock = threading.Lock()
+
+def start_model_warm_up():
+    global _model_warm_up_started
+    if os.getenv("YOLO_WARMUP_ON_START", "1") == "0":
+        return
+    with _model_warm_up_lock:
+        if _model_warm_up_started:
+            return
+        _model_warm_up_started = True
+    threading.Thread(target=warm_up_model, name="yolo-warmup", daemon=True).start()
+
+@app.before_request
+def _start_model_warm_up_in_worker():
+    # Under a WSGI server the first request (usually a health check) arrives after the worker has forked.
+    start_model_warm_up()
+
 
 MONGODB_URI=os.environ.get("MONGODB_URI")
 DB_NAME=os.environ.get("DB_NAME")
@@ -72,6 +104,83 @@ POPPLER_PATH = os.getenv("POPPLER_PATH", None)
 if POPPLER_PATH: app_logger.info(f"Flask app.py: POPPLER_PATH found: {POPPLER_PATH}")
 else: app_logger.info("Flask app.py: POPPLER_PATH not set (pdf2image will try to find Poppler in PATH).")
 
+# PDFs are rendered at the DPI the stored page images have always used; a page is only re-rendered at the
+# higher DPI (for YOLO region OCR only) when nothing could be extracted from it.
+PDF_DETECTION_DPI = int(os.getenv("PDF_DPI", "200"))
+PDF_RETRY_DPI = 300
+
+# Large JPEG uploads (phone photos) are decoded at a reduced DCT scale, never below this size.
+UPLOAD_IMAGE_DECODE_SIZE = (1600, 1600)
+
+PDF_RENDER_WORKERS = 2
+# Pages per Poppler call: pdf2image runs pdfinfo + pdftoppm for every call, so pages are rendered a few at a
+# time rather than one per call, while PDF_RENDER_WORKERS chunks in flight still bound how many are held in memory.
+PDF_RENDER_CHUNK_PAGES = 4
+
+# PyMuPDF is not thread-safe, so its renders are serialized; they still run off the request thread.
+_fitz_lock = threading.Lock()
+
+@contextlib.contextmanager
+def open_pdf_source(file_bytes):
+    # PyMuPDF renders straight from the bytes. Poppler needs a file, so the upload is written to a temp file
+    # once here instead of pdf2image re-writing the whole PDF for every render call.
+    if fitz is not None:
+        yield file_bytes
+        return
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pdf_path = os.path.join(tmp_dir, "upload.pdf")
+        with open(pdf_path, "wb") as pdf_file:
+            pdf_file.write(file_bytes)
+        yield pdf_path
+
+def get_pdf_page_count(pdf_source):
+    if fitz is not None:
+        with _fitz_lock, fitz.open(stream=pdf_source, filetype="pdf") as pdf_doc:
+            return pdf_doc.page_count
+    return int(pdfinfo_from_path(pdf_source, userpw=None, poppler_path=POPPLER_PATH)["Pages"])
+
+def render_pdf_pages(pdf_source, first_page, last_page, dpi):
+    if fitz is not None:
+        with _fitz_lock, fitz.open(stream=pdf_source, filetype="pdf") as pdf_doc:
+            pages = []
+            for page_index in range(first_page - 1, last_page):
+                pixmap = pdf_doc[page_index].get_pixmap(dpi=dpi, alpha=False)
+                pages.append(Image.frombytes("RGB", (pixmap.width, pixmap.height), pixmap.samples))
+            return pages
+    # PPM keeps the render lossless (these pages are stored as PNGs) and skips pdftoppm's image encoding.
+    return convert_from_path(pdf_source, dpi=dpi, fmt='ppm', first_page=first_page, last_page=last_page, poppler_path=POPPLER_PATH)
+
+class PdfPageRenderError(Exception):
+    """Raised by iter_pdf_pages when a page fails to render partway through a PDF."""
+
+def iter_pdf_pages(pdf_source, page_count, dpi):
+    # Renders PDF_RENDER_CHUNK_PAGES pages per call so only a bounded number of pages is held in memory.
+    # The next chunks are rendered ahead on background threads, so rasterization overlaps with
+    # YOLO/OCR on the pages already yielded.
+    with ThreadPoolExecutor(max_workers=PDF_RENDER_WORKERS) as executor:
+        pending_chunks = deque()
+        next_page_number = 1
+        while pending_chunks or next_page_number <= page_count:
+            while next_page_number <= page_count and len(pending_chunks) < PDF_RENDER_WORKERS:
+                last_page_number = min(page_count, next_page_number + PDF_RENDER_CHUNK_PAGES - 1)
+                pending_chunks.append((next_page_number, last_page_number, executor.submit(render_pdf_pages, pdf_source, next_page_number, last_page_number, dpi)))
+                next_page_number = last_page_number + 1
+            first_page_number, last_page_number, chunk_future = pending_chunks.popleft()
+            try:
+                chunk_pages = chunk_future.result()
+            except Exception as render_err:
+                raise PdfPageRenderError(f"Could not render pages {first_page_number}-{last_page_number}: {render_err}") from render_err
+            if len(chunk_pages) != last_page_number - first_page_number + 1:
+                raise PdfPageRenderError(f"Expected {last_page_number - first_page_number + 1} page(s) for pages {first_page_number}-{last_page_number}, got {len(chunk_pages)}")
+            yield from chunk_pages
+
+def iter_inferred_pages(pil_images):
+    # Pages are inferred in small batches so YOLO runs one forward pass per batch
+    # while only the current batch (plus the pages prefetched by iter_pdf_pages) is held in memory.
+    page_iter = iter(pil_images)
+    while page_batch := list(itertools.islice(page_iter, YOLO_BATCH_SIZE)):
+        yield from zip(page_batch, infer_course_text_from_image_objects(page_batch))
+
 
 @app.route('/', methods=['GET'])
 def health_check():
@@ -98,77 +207,109 @@ def upload_and_process_file():
     
     app.logger.info(f"Flask (Req ID: {req_id}): Processing '{original_name}' for userId '{user_id}'.")
     
+    # Owns the PDF temp file and the page render threads; closed once the request is done with the pages.
+    pdf_resources = contextlib.ExitStack()
     try:
         file_bytes = uploaded_file.read()
         content_type = uploaded_file.content_type
         
         pil_images = []
+        page_count = 1
         source_is_pdf = False
         
         if content_type == 'application/pdf':
             source_is_pdf = True
             try:
-                pdfinfo_from_bytes(file_bytes, userpw=None, poppler_path=POPPLER_PATH)
-                pil_images = convert_from_bytes(file_bytes, dpi=200, fmt='png', poppler_path=POPPLER_PATH)
-                app.logger.info(f"Flask (Req ID: {req_id}): PDF '{original_name}' converted to {len(pil_images)} image(s).")
+                pdf_source = pdf_resources.enter_context(open_pdf_source(file_bytes))
+                page_count = get_pdf_page_count(pdf_source)
+                pil_images = iter_pdf_pages(pdf_source, page_count, PDF_DETECTION_DPI)
+                # Registered after the temp file, so it runs first: pending renders finish before the file is removed.
+                pdf_resources.callback(pil_images.close)
+                app.logger.info(f"Flask (Req ID: {req_id}): PDF '{original_name}' has {page_count} page(s); rendering them {PDF_RENDER_CHUNK_PAGES} at a time.")
             except Exception as pdf_err:
                  app.logger.error(f"Flask (Req ID: {req_id}): PDF conversion failed for '{original_name}': {pdf_err}")
                  return jsonify({"error": f"Failed to process PDF: {str(pdf_err)}"}), 500
         elif content_type and content_type.startswith('image/'):
-            pil_images.append(Image.open(io.BytesIO(file_bytes)))
+            upload_image = Image.open(io.BytesIO(file_bytes))
+            if upload_image.format == 'JPEG':
+                upload_image.draft('RGB', UPLOAD_IMAGE_DECODE_SIZE)
+            pil_images.append(upload_image)
         else:
             return jsonify({"error": f"Unsupported file type: {content_type}"}), 415
 
         results_metadata = []
-        for i, img_pil in enumerate(pil_images):
-            page_number = i + 1
+        try:
+            for i, (img_pil, (extracted_courses, status)) in enumerate(iter_inferred_pages(pil_images)):
+                page_number = i + 1
             
-            extracted_courses, status = infer_course_text_from_image_object(img_pil)
-            course_name = max(extracted_courses, key=len) if extracted_courses else None
-            app.logger.info(f"Flask (Req ID: {req_id}): Page {page_number} of '{original_name}', Extracted Course: {course_name}, Status: {status}")
-
-            img_byte_arr = io.BytesIO()
-            img_pil.save(img_byte_arr, format='PNG')
-            img_byte_arr_val = img_byte_arr.getvalue()
+                if source_is_pdf and not extracted_courses:
+                    app.logger.info(f"Flask (Req ID: {req_id}): No course found on page {page_number} of '{original_name}' at {PDF_DETECTION_DPI} DPI. Re-rendering at {PDF_RETRY_DPI} DPI.")
+                    try:
+                        # Region OCR only: the full-page OCR + LLM fallback already ran on this page in the first pass.
+                        retry_img_pil = render_pdf_pages(pdf_source, page_number, page_number, PDF_RETRY_DPI)[0]
+                        retry_courses, retry_status = infer_course_text_from_image_regions(retry_img_pil)
+                        # Keep the high-DPI render only when it helped; otherwise the page is stored as first rendered.
+                        if retry_courses:
+                            img_pil, extracted_courses, status = retry_img_pil, retry_courses, retry_status
+                    except Exception as retry_err:
+                        app.logger.warning(f"Flask (Req ID: {req_id}): Re-rendering page {page_number} of '{original_name}' at {PDF_RETRY_DPI} DPI failed: {retry_err}")
+                course_name = max(extracted_courses, key=len) if extracted_courses else None
+                app.logger.info(f"Flask (Req ID: {req_id}): Page {page_number} of '{original_name}', Extracted Course: {course_name}, Status: {status}")
+
+                img_byte_arr = io.BytesIO()
+                img_pil.save(img_byte_arr, format='PNG')
+                img_byte_arr_val = img_byte_arr.getvalue()
             
-            final_original_name = f"{original_name} (Page {page_number})" if source_is_pdf and len(pil_images) > 1 else original_name
-            base_secure_name = secure_filename(os.path.splitext(original_name)[0])
-            gridfs_filename = f"{user_id}_{datetime.now().strftime('%Y%m%d%H%M%S%f')}_{base_secure_name}_page_{page_number}.png"
+                final_original_name = f"{original_name} (Page {page_number})" if source_is_pdf and page_count > 1 else original_name
+                base_secure_name = secure_filename(os.path.splitext(original_name)[0])
+                gridfs_filename = f"{user_id}_{datetime.now().strftime('%Y%m%d%H%M%S%f')}_{base_secure_name}_page_{page_number}.png"
             
-            metadata_for_gridfs = {
-                "userId": user_id,
-                "originalName": final_original_name,
-                "courseName": course_name,
-                "uploadedAt": datetime.now(timezone.utc).isoformat(),
-                "sourceContentType": content_type,
-                "convertedTo": "image/png" if source_is_pdf else None,
-                "pageNumber": page_number if source_is_pdf else None,
-                "visibility": "public"
-            }
-            metadata_for_gridfs = {k: v for k, v in metadata_for_gridfs.items() if v is not None}
-
-            file_id_obj = fs_images.put(
-                img_byte_arr_val,
-                filename=gridfs_filename,
-                contentType='image/png',
-                metadata=metadata_for_gridfs
-            )
-            app.logger.info(f"Flask (Req ID: {req_id}): Stored page {page_number} with GridFS ID: {str(file_id_obj)}. Metadata: {json.dumps(metadata_for_gridfs)}")
-
-            results_metadata.append({
-                "originalName": final_original_name,
-                "fileId": str(file_id_obj),
-                "filename": gridfs_filename,
-                "contentType": 'image/png',
-                "courseName": course_name,
-                "pageNumber": page_number if source_is_pdf else None,
-            })
+                metadata_for_gridfs = {
+                    "userId": user_id,
+                    "originalName": final_original_name,
+                    "courseName": course_name,
+                    "uploadedAt": datetime.now(timezone.utc).isoformat(),
+                    "sourceContentType": content_type,
+                    "convertedTo": "image/png" if source_is_pdf else None,
+                    "pageNumber": page_number if source_is_pdf else None,
+                    "visibility": "public"
+                }
+                metadata_for_gridfs = {k: v for k, v in metadata_for_gridfs.items() if v is not None}
+
+                file_id_obj = fs_images.put(
+                    img_byte_arr_val,
+                    filename=gridfs_filename,
+                    contentType='image/png',
+                    metadata=metadata_for_gridfs
+                )
+                app.logger.info(f"Flask (Req ID: {req_id}): Stored page {page_number} with GridFS ID: {str(file_id_obj)}. Metadata: {json.dumps(metadata_for_gridfs)}")
+
+                results_metadata.append({
+                    "originalName": final_original_name,
+                    "fileId": str(file_id_obj),
+                    "filename": gridfs_filename,
+                    "contentType": 'image/png',
+                    "courseName": course_name,
+                    "pageNumber": page_number if source_is_pdf else None,
+                })
+        except PdfPageRenderError as pdf_err:
+            # Pages are rendered lazily, so earlier pages may already be stored; remove them so a failed
+            # upload leaves nothing behind, matching the behaviour when the PDF cannot be opened at all.
+            for stored_page in results_metadata:
+                try:
+                    fs_images.delete(ObjectId(stored_page["fileId"]))
+                except Exception as cleanup_err:
+                    app.logger.warning(f"Flask (Req ID: {req_id}): Could not remove stored page {stored_page['fileId']} after PDF failure: {cleanup_err}")
+            app.logger.error(f"Flask (Req ID: {req_id}): PDF conversion failed for '{original_name}': {pdf_err}")
+            return jsonify({"error": f"Failed to process PDF: {str(pdf_err)}"}), 500
 
         return jsonify(results_metadata), 201
 
     except Exception as e:
         app.logger.error(f"Flask (Req ID: {req_id}): Unhandled error in /api/upload-and-process: {str(e)}", exc_info=True)
         return jsonify({"error": f"An unexpected error occurred: {str(e)}"}), 500
+    finally:
+        pdf_resources.close()
 
 @app.route('/api/manual-course-name', methods=['POST'])
 def save_manual_course_name():
@@ -408,6 +549,8 @@ if __name__ == '__main__':
     app.logger.info("Flask application starting with __name__ == '__main__'")
     app_logger.info(f"Effective MONGODB_URI configured: {'Yes' if MONGODB_URI else 'No'}")
     app_logger.info(f"Effective MONGODB_DB_NAME: {DB_NAME}")
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_model_warm_up() # The reloader's child process is the one serving requests
     app.run(host='0.0.0.0', port=int(os.environ.get("PORT", 5000)), debug=True)
 
     
@@ -1,40 +1,70 @@
 
 import logging
 import os
-import cv2
 import pytesseract
-from PIL import Image, UnidentifiedImageError
-from ultralytics import YOLO
-from pdf2image import convert_from_bytes
+from PIL import Image
 import numpy as np
 import re
-import nltk
-from nltk.corpus import words as nltk_words, stopwords
-# from sentence_transformers import SentenceTransformer, util # Currently unused, consider re-adding if semantic search needed
 import cohere
-# from difflib import SequenceMatcher # Currently unused
 import json
-import io
 import shutil # For shutil.which
+import sys
+import hashlib
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
 from typing import List, Optional, Tuple, Dict, Union
 from datetime import datetime, timezone # Added for timezone-aware datetimes
 
-# --- Initial Setup ---
-try:
-    nltk.data.find('corpora/words')
-except LookupError:
-    nltk.download('words', quiet=True)
-
 try:
-    nltk.data.find('corpora/stopwords')
-except LookupError:
-    nltk.download('stopwords', quiet=True)
+    from tesserocr import PyTessBaseAPI, PSM, OEM # In-process Tesseract API, avoids one subprocess per OCR call
+except ImportError:
+    PyTessBaseAPI = None
 
-english_vocab = set(w.lower() for w in nltk_words.words())
-stop_words = set(stopwords.words('english'))
+# --- Initial Setup ---
+class LRUCache:
+    """Small thread-safe in-process LRU map used to memoize expensive OCR and LLM results."""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, object]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: str, value) -> None:
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+# NLTK's English stopword list, inlined so importing this module needs no corpus download.
+stop_words = frozenset("""
+i me my myself we our ours ourselves you you're you've you'll you'd your yours yourself yourselves
+he him his himself she she's her hers herself it it's its itself they them their theirs themselves
+what which who whom this that that'll these those am is are was were be been being have has had
+having do does did doing a an the and but if or because as until while of at by for with about
+against between into through during before after above below to from up down in out on off over
+under again further then once here there when where why how all any both each few more most other
+some such no nor not only own same so than too very s t can will just don don't should should've
+now d ll m o re ve y ain aren aren't couldn couldn't didn didn't doesn doesn't hadn hadn't hasn
+hasn't haven haven't isn isn't ma mightn mightn't mustn mustn't needn needn't shan shan't shouldn
+shouldn't wasn wasn't weren weren't won won't wouldn wouldn't
+""".split())
 course_keywords = {"course", "certification", "developer", "programming", "bootcamp", "internship", "award", "degree", "diploma", "training"}
 
 pytesseract.pytesseract.tesseract_cmd = "/usr/bin/tesseract"
+# LSTM engine only. YOLO crops hold a single title line, so Tesseract's page layout analysis is skipped for them.
+TESSERACT_CROP_CONFIG = "--oem 1 --psm 7 -l eng"
+TESSERACT_FULL_IMAGE_CONFIG = "--oem 1 --psm 6 -l eng"
+FULL_IMAGE_OCR_MAX_SIDE = 2400 # Full-page fallback OCR runs on a copy no larger than this; a letter/A4 page at 200 DPI fits unscaled
 # --- Constants ---
 COHERE_API_KEY = os.environ.get("COHERE_API_KEY")
 
@@ -56,9 +86,55 @@ if not TESSERACT_PATH:
 else:
     logging.info(f"Tesseract OCR executable found at: {TESSERACT_PATH}")
 
+USE_TESSEROCR = PyTessBaseAPI is not None
+if not USE_TESSEROCR:
+    logging.info("tesserocr not installed. OCR will use pytesseract (one tesseract subprocess per call).")
+
+# A PyTessBaseAPI instance is not thread-safe, so each worker thread keeps its own.
+_tesseract_thread_local = threading.local()
+
+def _get_tesseract_api():
+    global USE_TESSEROCR
+    api = getattr(_tesseract_thread_local, "api", None)
+    if api is None:
+        try:
+            api = PyTessBaseAPI(lang="eng", oem=OEM.LSTM_ONLY)
+        except RuntimeError as tess_init_err:
+            logging.error(f"Could not initialize tesserocr ({tess_init_err}). Falling back to pytesseract.")
+            USE_TESSEROCR = False
+            return None
+        _tesseract_thread_local.api = api
+    return api
+
+# Tesseract's LSTM recognizer parallelizes with OpenMP pragmas that request a fixed 4 threads, which a thread pool
+# cannot override from inside the process. OMP_THREAD_LIMIT caps them only when it is set before the process starts.
+TESSERACT_THREADS_PER_CALL = max(1, min(4, int(os.getenv("OMP_THREAD_LIMIT") or 4)))
+
+# Tesseract releases the GIL while recognizing, so region crops can be OCRed in parallel threads. The pool is sized
+# so concurrent calls times Tesseract's own threads stays within the cores instead of oversubscribing them.
+_ocr_pool = ThreadPoolExecutor(max_workers=max(1, (os.cpu_count() or 2) // TESSERACT_THREADS_PER_CALL), thread_name_prefix="ocr")
+
+def ocr_image_text(pil_image: Image.Image, single_line: bool = False) -> str:
+    api = _get_tesseract_api() if USE_TESSEROCR else None
+    if api is not None:
+        # Hand Tesseract the raw pixel buffer; SetImage(pil) would round-trip the crop through an encoded image.
+        # Tesseract thresholds a greyscale copy anyway, so convert up front and pass a third of the bytes.
+        if pil_image.mode != "L":
+            pil_image = pil_image.convert("L")
+        api.SetPageSegMode(PSM.SINGLE_LINE if single_line else PSM.SINGLE_BLOCK)
+        api.SetImageBytes(pil_image.tobytes(), pil_image.width, pil_image.height, 1, pil_image.width)
+        return api.GetUTF8Text().strip()
+    config = TESSERACT_CROP_CONFIG if single_line else TESSERACT_FULL_IMAGE_CONFIG
+    return pytesseract.image_to_string(pil_image, config=config).strip()
+
 
 possible_courses = ["HTML", "CSS", "JavaScript", "React", "Astro.js", "Python", "Flask", "C Programming", "Kotlin", "Ethical Hacking", "Networking", "Node.js", "Machine Learning", "Data Structures", "Operating Systems", "Next.js", "Remix", "Express.js", "MongoDB", "Docker", "Kubernetes", "Tailwind CSS", "Django", "Typescript"]
 
+# Built once: a lookahead alternation reports every course at every position in a single scan,
+# including overlapping names such as "CSS" inside "Tailwind CSS".
+_COURSE_NAME_BY_LOWER = {course.lower(): course for course in possible_courses}
+_COURSE_NAME_PATTERN = re.compile(r'(?=\b(' + '|'.join(re.escape(name) for name in sorted(_COURSE_NAME_BY_LOWER, key=len, reverse=True)) + r')\b)')
+
 course_graph = {
     "HTML": {
         "description": "HTML (HyperText Markup Language) is the standard language for creating webpages.",
@@ -131,37 +207,102 @@ course_graph = {
 }
 
 YOLO_MODEL_PATH = "models/best.pt"
+YOLO_INPUT_SIZE = 640 # Longest side the detector was trained on; larger inputs are only downscaled by YOLO anyway
+RELEVANT_YOLO_LABELS = ["certificatecourse", "course", "title"]
+YOLO_BATCH_SIZE = 8 # Pages per forward pass; app.py also groups uploaded pages into batches of this size
+# Split the cores between server worker processes so torch's intra-op threads do not oversubscribe the CPU.
+YOLO_TORCH_THREADS = max(1, (os.cpu_count() or 2) // max(1, int(os.getenv("WEB_CONCURRENCY", "1"))))
+# Set YOLO_AUTO_EXPORT_ONNX=1 to export models/best.pt to ONNX on first load when no export exists yet.
+YOLO_AUTO_EXPORT_ONNX = os.getenv("YOLO_AUTO_EXPORT_ONNX", "").lower() in ("1", "true", "yes")
 model = None
+_yolo_half_precision = False # Set when the PyTorch weights are moved to a CUDA device
+_yolo_max_batch_size = YOLO_BATCH_SIZE # Dropped to 1 if the loaded export turns out to have a static batch axis
+_model_load_lock = threading.Lock()
+_yolo_inference_lock = threading.Lock()
 def load_model():
-    global model
+    # Loaded on first use rather than at import, so processes that never run inference skip the cost.
     if model is not None:
         return model
-
+    with _model_load_lock:
+        if model is not None:
+            return model
+        return _load_model_from_disk()
+
+def warm_up_model():
+    # Load the model and run one full-size dummy batch so the first real request does not pay for weight loading
+    # and backend initialisation. Going through detect_course_regions at YOLO_BATCH_SIZE also exercises batched
+    # input, so an export with a static batch axis is detected (and the batch size lowered) here rather than on
+    # a user's upload. Meant to run in a background thread in the serving process.
+    try:
+        yolo_model = load_model()
+        detect_course_regions(yolo_model, [Image.new("RGB", (YOLO_INPUT_SIZE, YOLO_INPUT_SIZE), "white")] * YOLO_BATCH_SIZE)
+        logging.info("YOLO model warmed up.")
+    except Exception as e:
+        logging.warning(f"YOLO warm-up failed; the model will be loaded on first use instead: {e}")
+
+def _resolve_yolo_weights_path(pt_path: str, cuda_available: bool = False) -> str:
+    # On a GPU host prefer a TensorRT engine built offline next to the weights. Build it with a dynamic batch axis sized
+    # to YOLO_BATCH_SIZE, e.g. `yolo export model=models/best.pt format=engine half=True dynamic=True batch=8 imgsz=640`;
+    # a static batch-1 engine only works through the slow one-image-per-call fallback in detect_course_regions.
+    engine_path = os.path.splitext(pt_path)[0] + ".engine"
+    if cuda_available and os.path.exists(engine_path):
+        return engine_path
+    # Otherwise prefer an ONNX export; Ultralytics runs it through ONNX Runtime,
+    # which avoids the eager PyTorch overhead on CPU.
+    onnx_path = os.path.splitext(pt_path)[0] + ".onnx"
+    if not os.path.exists(onnx_path) and YOLO_AUTO_EXPORT_ONNX:
+        try:
+            from ultralytics import YOLO
+            # dynamic=True keeps the batch axis variable; detect_course_regions sends up to YOLO_BATCH_SIZE pages per call.
+            onnx_path = YOLO(pt_path, task="detect").export(format="onnx", imgsz=YOLO_INPUT_SIZE, dynamic=True, batch=YOLO_BATCH_SIZE, simplify=True)
+            logging.info(f"Exported YOLO model to ONNX: {onnx_path}")
+        except Exception as export_err:
+            logging.warning(f"Could not export YOLO model to ONNX, using PyTorch weights: {export_err}")
+    return onnx_path if onnx_path and os.path.exists(onnx_path) else pt_path
+
+def _load_model_from_disk():
+    global model, _yolo_half_precision
+    from ultralytics import YOLO # Imported here: ultralytics pulls in torch, which dominates import time
+    import torch
+    torch.set_num_threads(YOLO_TORCH_THREADS)
+    cuda_available = torch.cuda.is_available()
     # Construct a path relative to the script's location
     script_dir = os.path.dirname(os.path.abspath(__file__))
     model_path_from_script = os.path.join(script_dir, "models", "best.pt")
 
     try:
         if os.path.exists(model_path_from_script):
-            model = YOLO(model_path_from_script)
-            logging.info(f"Successfully loaded YOLO model from relative path: {model_path_from_script}")
+            weights_path = _resolve_yolo_weights_path(model_path_from_script, cuda_available)
+            loaded_model = YOLO(weights_path, task="detect")
+            logging.info(f"Successfully loaded YOLO model from relative path: {weights_path}")
         elif os.path.exists(YOLO_MODEL_PATH):
              # Fallback to the hardcoded path if relative path fails
-            model = YOLO(YOLO_MODEL_PATH)
-            logging.info(f"Successfully loaded YOLO model from hardcoded fallback path: {YOLO_MODEL_PATH}")
+            weights_path = _resolve_yolo_weights_path(YOLO_MODEL_PATH, cuda_available)
+            loaded_model = YOLO(weights_path, task="detect")
+            logging.info(f"Successfully loaded YOLO model from hardcoded fallback path: {weights_path}")
         else:
             logging.error(f"YOLO model not found at primary path '{model_path_from_script}' or fallback '{YOLO_MODEL_PATH}'")
             raise FileNotFoundError("YOLO model not found.")
 
-        model.to("cpu")
+        # Only the PyTorch weights can be moved; exported backends are bound to their runtime.
+        if weights_path.endswith(".pt"):
+            if cuda_available:
+                loaded_model.to("cuda")
+                _yolo_half_precision = True
+                logging.info("CUDA available: running YOLO on the GPU in half precision.")
+            else:
+                loaded_model.to("cpu")
+        # Published last: load_model's unlocked fast path must never see a model that is not on its device yet.
+        model = loaded_model
         return model
 
     except Exception as e:
         logging.error(f"Error loading YOLO model: {e}")
         raise e
-model = load_model()
 
 def clean_unicode(text):
+    if text.isascii(): # Nothing to replace; skips two full copies for the common all-ASCII OCR output
+        return text
     return text.encode("utf-8", "replace").decode("utf-8")
 
 def query_llm_for_course_from_text(text_content: str) -> Optional[str]:
@@ -197,51 +338,162 @@ Extracted Course Name:"""
         logging.error(f"Error querying Cohere LLM for course extraction: {e}")
         return None
 
-def infer_course_text_from_image_object(pil_image_obj: Image.Image) -> Tuple[List[str], str]:
-    extracted_courses: List[str] = []
+def detect_course_regions(yolo_model, pil_images: List[Image.Image]) -> List[List[Tuple[str, Tuple[int, int, int, int]]]]:
+    """Runs YOLO over the images in batches and returns, per image, the relevant (label, box) regions in original-image coordinates."""
+    detection_images = []
+    scales = []
+    for pil_image_obj in pil_images:
+        # Detect on a downscaled copy; the full-resolution image is kept for the Tesseract crops.
+        width, height = pil_image_obj.size
+        scale = min(1.0, YOLO_INPUT_SIZE / max(width, height))
+        if scale < 1.0:
+            detection_image = pil_image_obj.resize((max(1, int(width * scale)), max(1, int(height * scale))), Image.BILINEAR)
+        else:
+            detection_image = pil_image_obj
+
+        if detection_image.mode != "RGB":
+            detection_image = detection_image.convert("RGB")
+        detection_images.append(np.asarray(detection_image))
+        scales.append(scale)
+
+    global _yolo_max_batch_size
+    results = []
+    batch_start = 0
+    # The ultralytics predictor keeps per-call state on the model object, so concurrent requests (and the warm-up
+    # thread) take turns; the lock also guards the batch size fallback below.
+    with _yolo_inference_lock:
+        while batch_start < len(detection_images):
+            batch = detection_images[batch_start:batch_start + _yolo_max_batch_size]
+            try:
+                batch_results = yolo_model(batch, half=_yolo_half_precision, verbose=False)
+            except Exception as batch_err:
+                if len(batch) == 1:
+                    raise
+                # An ONNX/TensorRT export built with a fixed batch of 1 rejects larger inputs; run one page per call from now on.
+                logging.warning(f"Batched YOLO inference failed ({batch_err}); the model may have a static batch size. Falling back to one image per call.")
+                _yolo_max_batch_size = 1
+                continue
+            results.extend(batch_results)
+            batch_start += len(batch)
+
+    regions_per_image = []
+    for result, scale in zip(results, scales):
+        regions = []
+        boxes = result.boxes
+        if boxes is not None and len(boxes) > 0:
+            # Pull classes and coordinates off the device once instead of per box.
+            class_ids = boxes.cls.cpu().numpy().astype(int)
+            box_coords = (boxes.xyxy.cpu().numpy() / scale).astype(int)
+            labels = np.array([result.names[cls_id] for cls_id in class_ids])
+            relevant_mask = np.isin(np.char.lower(labels), RELEVANT_YOLO_LABELS)
+            regions = [(str(label), tuple(int(coord) for coord in box)) for label, box in zip(labels[relevant_mask], box_coords[relevant_mask])]
+        regions_per_image.append(regions)
+    return regions_per_image
+
+# Successful extractions keyed by a hash of the decoded pixels, so re-uploads of the same certificate skip YOLO and OCR.
+_extraction_result_cache = LRUCache(max_size=512)
+
+def _image_content_key(pil_image_obj: Image.Image) -> str:
+    digest = hashlib.blake2b(pil_image_obj.tobytes(), digest_size=16)
+    digest.update(f"{pil_image_obj.mode}:{pil_image_obj.size}".encode())
+    return digest.hexdigest()
+
+def infer_course_text_from_image_objects(pil_images: List[Image.Image]) -> List[Tuple[List[str], str]]:
+    if not pil_images:
+        return []
+
+    cache_keys = [_image_content_key(pil_image_obj) for pil_image_obj in pil_images]
+    results: List[Optional[Tuple[List[str], str]]] = [_extraction_result_cache.get(key) for key in cache_keys]
+    # Identical images in the same batch (e.g. repeated PDF pages) are only run through inference once.
+    uncached_indices_by_key: Dict[str, List[int]] = {}
+    for i, result in enumerate(results):
+        if result is None:
+            uncached_indices_by_key.setdefault(cache_keys[i], []).append(i)
+    if len(uncached_indices_by_key) < len(pil_images):
+        logging.info(f"Reusing cached or duplicate extraction results for {len(pil_images) - len(uncached_indices_by_key)} of {len(pil_images)} image(s).")
+
+    if uncached_indices_by_key:
+        fresh_results = _run_course_inference([pil_images[indices[0]] for indices in uncached_indices_by_key.values()])
+        for (key, indices), result in zip(uncached_indices_by_key.items(), fresh_results):
+            for i in indices:
+                results[i] = result
+            if result[1].startswith("SUCCESS"):
+                _extraction_result_cache.put(key, result)
+
+    return [(list(courses), status) for courses, status in results]
+
+def _run_course_inference(pil_images: List[Image.Image], full_image_fallback: bool = True) -> List[Tuple[List[str], str]]:
+    # Normalise palette/RGBA pages once here, rather than converting every region crop and the full-image OCR separately.
+    pil_images = [img if img.mode in ("RGB", "L") else img.convert("RGB") for img in pil_images]
+    regions_per_image: List[List[Tuple[str, Tuple[int, int, int, int]]]] = [[] for _ in pil_images]
     status_message: str = "FAILURE_NO_COURSE_IDENTIFIED"
 
-    if not model:
+    try:
+        yolo_model = load_model()
+    except Exception:
+        yolo_model = None
+
+    if not yolo_model:
         logging.error("YOLO model is not loaded. Cannot perform regional inference.")
     elif TESSERACT_PATH:
         try:
-            image_np = np.array(pil_image_obj)
-            if image_np.ndim == 2: image_np = cv2.cvtColor(image_np, cv2.COLOR_GRAY2RGB)
-            elif image_np.shape[2] == 4: image_np = cv2.cvtColor(image_np, cv2.COLOR_RGBA2RGB)
-
-            results = model(image_np)
-            names = results[0].names
-            boxes = results[0].boxes
-
-            if boxes is not None and len(boxes) > 0:
-                for box in boxes:
-                    cls_id = int(box.cls[0].item())
-                    label = names[cls_id]
-                    if label.lower() in ["certificatecourse", "course", "title"]:
-                        left, top, right, bottom = map(int, box.xyxy[0].cpu().numpy())
-                        cropped_pil_image = pil_image_obj.crop((left, top, right, bottom))
-                        try:
-                            regional_text = pytesseract.image_to_string(cropped_pil_image).strip()
-                            regional_text_cleaned = clean_unicode(regional_text)
-                            if regional_text_cleaned:
-                                logging.info(f"Extracted text from YOLO region ('{label}'): '{regional_text_cleaned}'")
-                                courses_from_region = filter_and_verify_course_text(regional_text_cleaned)
-                                if courses_from_region:
-                                    extracted_courses.extend(courses_from_region)
-                                    status_message = "SUCCESS_YOLO_OCR"
-                                    return list(set(extracted_courses)), status_message 
-                        except pytesseract.TesseractError as tess_err:
-                            logging.warning(f"PytesseractError on YOLO region ('{label}'): {tess_err}")
-                        except Exception as ocr_crop_err:
-                            logging.warning(f"Error OCRing YOLO region ('{label}'): {ocr_crop_err}")
+            regions_per_image = detect_course_regions(yolo_model, pil_images)
         except Exception as yolo_err:
             logging.error(f"Error during YOLO inference: {yolo_err}", exc_info=True)
             status_message = "FAILURE_YOLO_ERROR"
 
-    if not extracted_courses and TESSERACT_PATH:
+    return [
+        _extract_courses_from_image(pil_image_obj, regions, status_message, full_image_fallback)
+        for pil_image_obj, regions in zip(pil_images, regions_per_image)
+    ]
+
+def infer_course_text_from_image_object(pil_image_obj: Image.Image) -> Tuple[List[str], str]:
+    return infer_course_text_from_image_objects([pil_image_obj])[0]
+
+def infer_course_text_from_image_regions(pil_image_obj: Image.Image) -> Tuple[List[str], str]:
+    # YOLO region OCR only, without the full-image OCR + LLM fallback. Used to retry a page at a higher
+    # resolution after the normal pipeline (fallback included) has already come up empty for it.
+    return _run_course_inference([pil_image_obj], full_image_fallback=False)[0]
+
+def _extract_courses_from_image(
+    pil_image_obj: Image.Image,
+    regions: List[Tuple[str, Tuple[int, int, int, int]]],
+    status_message: str,
+    full_image_fallback: bool = True
+) -> Tuple[List[str], str]:
+    extracted_courses: List[str] = []
+
+    if TESSERACT_PATH and regions:
+        # OCR every region concurrently, then take the first one (in detection order) that yields a course.
+        ocr_futures = [_ocr_pool.submit(ocr_image_text, pil_image_obj.crop(box), True) for _, box in regions]
+        for (label, _), ocr_future in zip(regions, ocr_futures):
+            try:
+                regional_text = ocr_future.result()
+                regional_text_cleaned = clean_unicode(regional_text)
+                if regional_text_cleaned:
+                    logging.info(f"Extracted text from YOLO region ('{label}'): '{regional_text_cleaned}'")
+                    courses_from_region = filter_and_verify_course_text(regional_text_cleaned)
+                    if courses_from_region:
+                        extracted_courses.extend(courses_from_region)
+                        status_message = "SUCCESS_YOLO_OCR"
+                        for pending_future in ocr_futures:
+                            pending_future.cancel()
+                        return list(dict.fromkeys(extracted_courses)), status_message 
+            except pytesseract.TesseractError as tess_err:
+                logging.warning(f"PytesseractError on YOLO region ('{label}'): {tess_err}")
+            except Exception as ocr_crop_err:
+                logging.warning(f"Error OCRing YOLO region ('{label}'): {ocr_crop_err}")
+
+    if not extracted_courses and TESSERACT_PATH and full_image_fallback:
         logging.info("No courses from YOLO or YOLO skipped. Attempting full image OCR + LLM.")
         try:
-            full_image_text = pytesseract.image_to_string(pil_image_obj).strip()
+            full_image = pil_image_obj
+            if max(full_image.size) > FULL_IMAGE_OCR_MAX_SIDE:
+                full_image = full_image.copy()
+                full_image.thumbnail((FULL_IMAGE_OCR_MAX_SIDE, FULL_IMAGE_OCR_MAX_SIDE), Image.BILINEAR)
+            # Run on the OCR pool too, so the tesserocr instance is the pool thread's long-lived one rather than
+            # a fresh one (full tessdata load) on whichever short-lived thread is serving this request.
+            full_image_text = _ocr_pool.submit(ocr_image_text, full_image).result()
             full_image_text_cleaned = clean_unicode(full_image_text)
 
             if not full_image_text_cleaned or len(full_image_text_cleaned) < 5:
@@ -257,7 +509,7 @@ def infer_course_text_from_image_object(pil_image_obj: Image.Image) -> Tuple[Lis
                     if courses_from_llm:
                         extracted_courses.extend(courses_from_llm)
                         status_message = "SUCCESS_LLM_EXTRACTION_FROM_FULL_OCR"
-                        return list(set(extracted_courses)), status_message
+                        return list(dict.fromkeys(extracted_courses)), status_message
                     else:
                         logging.info("LLM output filtered to no valid courses.")
                         status_message = "FAILURE_LLM_OUTPUT_FILTERED_EMPTY"
@@ -276,71 +528,81 @@ def infer_course_text_from_image_object(pil_image_obj: Image.Image) -> Tuple[Lis
         status_message = "FAILURE_TESSERACT_NOT_FOUND"
         logging.error("Tesseract not found, cannot perform any OCR steps.")
 
-    return list(set(extracted_courses)), status_message
+    return list(dict.fromkeys(extracted_courses)), status_message
 
 
 def extract_course_names_from_text(text):
     if not text: return []
-    found_courses = []
     text_lower = text.lower()
-    for course in possible_courses:
-        if re.search(r'\b' + re.escape(course.lower()) + r'\b', text_lower):
-            found_courses.append(course)
-    return list(set(found_courses))
+    # Plain substring checks are much cheaper than the regex scan and rule out the common no-course case.
+    if not any(course_lower in text_lower for course_lower in _COURSE_NAME_BY_LOWER):
+        return []
+    return list(dict.fromkeys(_COURSE_NAME_BY_LOWER[match.group(1)] for match in _COURSE_NAME_PATTERN.finditer(text_lower)))
+
+_CENT_SIGN_PATTERN = re.compile(r'\s*¢\s*')
+_BOILERPLATE_PHRASES_PATTERN = re.compile("|".join(re.escape(phrase) for phrase in ["certificate of completion", "certificate of achievement", "is awarded to", "has successfully completed"]))
+_COURSE_KEYWORD_PATTERN = re.compile("|".join(re.escape(kw) for kw in course_keywords))
 
 def filter_and_verify_course_text(text_input: Optional[str]) -> List[str]:
     if not text_input or len(text_input.strip()) < 3:
         return []
     
-    text = re.sub(r'\s*¢\s*', '', text_input.strip()).strip()
+    text = _CENT_SIGN_PATTERN.sub('', text_input.strip()).strip()
     if not text: 
         return []
 
-    phrases_to_remove = ["certificate of completion", "certificate of achievement", "is awarded to", "has successfully completed"]
-    temp_text = text.lower()
-    for phrase in phrases_to_remove:
-        temp_text = temp_text.replace(phrase, "")
+    text_lower = text.lower()
+    is_short_llm_like_input = len(text.split()) <= 7 and '\n' not in text
+    temp_text = _BOILERPLATE_PHRASES_PATTERN.sub("", text_lower)
     
     potential_course_lines = [line.strip() for line in temp_text.split('\n') if len(line.strip()) > 4]
-    if len(text.split()) <= 7 and '\n' not in text: 
-        potential_course_lines.append(text.lower()) 
+    if is_short_llm_like_input: 
+        potential_course_lines.append(text_lower) 
 
-    identified_courses = []
-    direct_matches_from_list = extract_course_names_from_text(text)
-    for dm in direct_matches_from_list:
-        identified_courses.append(dm)
+    # Dict used as an ordered set, so membership checks are O(1) and no set/list round-trip is needed on return.
+    identified_courses: Dict[str, None] = dict.fromkeys(extract_course_names_from_text(text))
         
+    # Lines are already lowercase, so they are compared against the precomputed lowercase course names directly.
     for line_text in potential_course_lines:
-        if not line_text or line_text.lower() in stop_words:
+        if not line_text or line_text in stop_words:
             continue
-        is_known_course = False
-        for pc in possible_courses:
-            if pc.lower() in line_text.lower():
-                if pc not in identified_courses: identified_courses.append(pc)
-                is_known_course = True
-                break 
-        
-        if not is_known_course:
+        known_course = next((course for course_lower, course in _COURSE_NAME_BY_LOWER.items() if course_lower in line_text), None)
+        if known_course:
+            identified_courses[known_course] = None
+        else:
             words_in_line = line_text.split()
+            # Cheapest checks first: the word-count bound rules out most OCR lines before any keyword scan.
             is_plausible_new_course = (
-                any(kw in line_text for kw in course_keywords) and 
+                2 <= len(words_in_line) <= 7 and 
+                _COURSE_KEYWORD_PATTERN.search(line_text) is not None and 
                 not all(word in course_keywords or word in stop_words or not word.isalnum() for word in words_in_line) and 
-                len(words_in_line) >= 2 and len(words_in_line) <= 7 and 
-                any(word.lower() not in stop_words and len(word) > 2 for word in words_in_line) 
+                any(word not in stop_words and len(word) > 2 for word in words_in_line) 
             )
-            is_short_llm_like_input = len(text.split()) <= 7 and '\n' not in text
 
-            if is_plausible_new_course or (is_short_llm_like_input and line_text == text.lower()):
+            if is_plausible_new_course or (is_short_llm_like_input and line_text == text_lower):
                 title_cased_line = line_text.title()
                 if title_cased_line not in identified_courses: 
                     cleaned_title_cased_line = title_cased_line 
                     if cleaned_title_cased_line: 
-                         identified_courses.append(f"{cleaned_title_cased_line} [UNVERIFIED]") 
+                         identified_courses[f"{cleaned_title_cased_line} [UNVERIFIED]"] = None
                     
-    return list(set(identified_courses))
+    return list(identified_courses)
+
+
+LLM_FALLBACK_CONCURRENCY = 4 # Individual Cohere fallback requests in flight at once; kept small for rate limits
+
+# Recent Cohere suggestion responses and their parsed blocks, keyed by the normalized course list, so repeated
+# requests skip the round-trip.
+_llm_suggestions_cache = LRUCache(max_size=256)
 
+def _llm_suggestions_cache_key(course_names: List[str]) -> str:
+    return "\n".join(sorted(name.strip().lower() for name in course_names))
 
-def query_llm_for_detailed_suggestions(known_course_names_list_cleaned: List[str]):
+def _llm_blocks_cover_courses(parsed_blocks: List[Dict[str, any]], course_names: List[str]) -> bool:
+    parsed_names_lower = {block["original_input_course_from_llm"].strip().lower() for block in parsed_blocks}
+    return all(name.strip().lower() in parsed_names_lower for name in course_names)
+
+def query_llm_for_detailed_suggestions(known_course_names_list_cleaned: List[str], bypass_cache: bool = False):
     if not co:
         logging.warning("Cohere client not initialized. Skipping LLM suggestions.")
         return {"error": "Cohere LLM not available."}
@@ -348,6 +610,13 @@ def query_llm_for_detailed_suggestions(known_course_names_list_cleaned: List[str
         logging.warning("No known course names provided to Cohere LLM for suggestions.")
         return {"error": "No known course names provided for Cohere suggestions."}
 
+    # bypass_cache is set for forced refreshes: the cache is skipped on read, and a good fresh response replaces the entry.
+    cache_key = _llm_suggestions_cache_key(known_course_names_list_cleaned)
+    cached_response = None if bypass_cache else _llm_suggestions_cache.get(cache_key)
+    if cached_response is not None:
+        logging.info(f"Cohere LLM suggestions served from in-process cache for courses: {known_course_names_list_cleaned}")
+        return cached_response
+
     prompt_course_list_str = ', '.join(f"'{c}'" for c in known_course_names_list_cleaned)
 
     prompt = f"""
@@ -383,15 +652,83 @@ Suggested Next Courses:
 (If there was another course in the input like 'JavaScript', its block would follow here)
 """
     try:
-        response = co.chat(model="command-r-plus", message=prompt, temperature=0.3)
-        logging.info(f"Cohere LLM raw response for detailed suggestions (courses: {prompt_course_list_str}) (first 500 chars): {response.text[:500]}...")
-        if "invalid api token" in response.text.lower():
-            raise Exception(f"Cohere API Error: {response.text}")
-        return {"text": response.text.strip()}
+        # Stream the response and stop reading once the parser has a complete block for every requested course.
+        # The text is only re-parsed when a new '---' separator arrives, since blocks can only complete there.
+        # closing() releases the HTTP stream when we stop early.
+        response_text = ""
+        separators_seen = 0
+        parsed_blocks = None
+        with contextlib.closing(co.chat_stream(model="command-r-plus", message=prompt, temperature=0.3)) as response_stream:
+            for event in response_stream:
+                if event.event_type != "text-generation":
+                    continue
+                response_text += event.text
+                separator_count = response_text.count("\n---\n")
+                if separator_count > separators_seen:
+                    separators_seen = separator_count
+                    stream_blocks = parse_llm_detailed_suggestions_response(response_text)
+                    if _llm_blocks_cover_courses(stream_blocks, known_course_names_list_cleaned):
+                        parsed_blocks = stream_blocks
+                        break
+        logging.info(f"Cohere LLM raw response for detailed suggestions (courses: {prompt_course_list_str}) (first 500 chars): {response_text[:500]}...")
+        if "invalid api token" in response_text.lower():
+            raise Exception(f"Cohere API Error: {response_text}")
+        response_text = response_text.strip()
+        if parsed_blocks is None:
+            parsed_blocks = parse_llm_detailed_suggestions_response(response_text)
+        llm_response = {"text": response_text, "parsed": parsed_blocks}
+        # Only cache replies with a block for every requested course, so a partial reply is not replayed on retries.
+        if _llm_blocks_cover_courses(parsed_blocks, known_course_names_list_cleaned):
+            _llm_suggestions_cache.put(cache_key, llm_response)
+        return llm_response
     except Exception as e:
         logging.error(f"Error querying Cohere LLM for detailed suggestions (courses: {prompt_course_list_str}): {e}")
         return {"error": f"Error from LLM: {str(e)}"}
 
+# Tolerates an optional list marker ("-", "*", "1.") and markdown emphasis around the field name,
+# e.g. "1. Original Input Course: X" or "- **Name:** Y".
+_LLM_FIELD_PATTERN = re.compile(r"^(?:[-*]|\d+[.)])?\s*\**\s*(original input course|ai description|suggested next courses|name|description|url)\s*\**\s*:\s*\**\s*(.*?)\**\s*$", re.IGNORECASE)
+_LLM_URL_PATTERN = re.compile(r"https?://\S+")
+_LLM_CODE_FENCE_OPEN_PATTERN = re.compile(r"```(?:json|text)?\n?")
+_LLM_CODE_FENCE_CLOSE_PATTERN = re.compile(r"\n?```")
+
+def _finish_llm_suggestion(suggestion: Optional[Dict[str, str]], current_suggestions: List[Dict[str, str]], original_input_course_from_llm: Optional[str]) -> None:
+    if suggestion is None:
+        return
+    if suggestion.get("name") and suggestion.get("description") and suggestion.get("url"):
+        current_suggestions.append(suggestion)
+    else:
+        logging.warning(f"LLM Parser: Could not parse full suggestion (name, desc, or URL missing) in block for Original Input '{original_input_course_from_llm}'. Parsed fields: {suggestion}")
+
+def _finish_llm_block(block: Optional[Dict[str, any]], parsed_results: List[Dict[str, Union[str, None, List[Dict[str, str]]]]]) -> None:
+    if block is None:
+        return
+    original_input_course_from_llm = block["original_input_course"]
+    if not original_input_course_from_llm:
+        logging.warning(f"LLM Parser: Could not find 'Original Input Course' in block. Block lines (first 3): {block['raw_lines'][:3]}")
+        return
+    _finish_llm_suggestion(block["suggestion"], block["suggestions"], original_input_course_from_llm)
+
+    ai_description = None
+    if block["ai_description_lines"] is None:
+        logging.warning(f"LLM Parser: Could not find 'AI Description' for Original Input '{original_input_course_from_llm}'.")
+    else:
+        desc_text = "\n".join(block["ai_description_lines"]).strip()
+        if desc_text.lower() != "no ai description available.":
+            ai_description = desc_text
+
+    if not block["saw_suggestions_header"]:
+        logging.warning(f"LLM Parser: 'Suggested Next Courses:' section not found or malformed for Original Input '{original_input_course_from_llm}'.")
+    elif block["no_suggestions"]:
+        logging.info(f"LLM Parser: No specific suggestions for Original Input '{original_input_course_from_llm}'.")
+
+    parsed_results.append({
+        "original_input_course_from_llm": original_input_course_from_llm,
+        "ai_description": ai_description,
+        "llm_suggestions": block["suggestions"]
+    })
+    logging.info(f"LLM Parser: Parsed for Original Input '{original_input_course_from_llm}', AI Desc: {'Present' if ai_description else 'None'}, Suggestions: {len(block['suggestions'])}")
+
 def parse_llm_detailed_suggestions_response(llm_response_text: str) -> List[Dict[str, Union[str, None, List[Dict[str, str]]]]]:
     parsed_results = []
     if not llm_response_text or \
@@ -402,90 +739,64 @@ def parse_llm_detailed_suggestions_response(llm_response_text: str) -> List[Dict
         return parsed_results
 
     cleaned_response_text = llm_response_text.replace('\r\n', '\n')
-    cleaned_response_text = re.sub(r"```(?:json|text)?\n?", "", cleaned_response_text)
-    cleaned_response_text = re.sub(r"\n?```", "", cleaned_response_text)
-
-    main_blocks = re.split(r'\n---\n', cleaned_response_text)
-    logging.info(f"LLM Parser: Split into {len(main_blocks)} main identified course blocks.")
-
-    for block_text in main_blocks:
-        block_text = block_text.strip()
-        if not block_text:
+    cleaned_response_text = _LLM_CODE_FENCE_OPEN_PATTERN.sub("", cleaned_response_text)
+    cleaned_response_text = _LLM_CODE_FENCE_CLOSE_PATTERN.sub("", cleaned_response_text)
+
+    # Single pass over the lines: each "Field: value" line is an event for a small state machine,
+    # and a line containing only '---' closes the current course block.
+    block: Optional[Dict[str, any]] = None
+    section: Optional[str] = None
+    for raw_line in cleaned_response_text.split('\n'):
+        line = raw_line.strip()
+        if line == "---":
+            _finish_llm_block(block, parsed_results)
+            block, section = None, None
             continue
-
-        original_input_course_match = re.search(r"Original Input Course:\s*(.*?)\n", block_text, re.IGNORECASE)
-        ai_description_match = re.search(r"AI Description:\s*(.*?)(?:\nSuggested Next Courses:|\Z)", block_text, re.IGNORECASE | re.DOTALL)
-        
-        if not original_input_course_match:
-            logging.warning(f"LLM Parser: Could not find 'Original Input Course' in block. Full block text (first 300 chars): '{block_text[:300]}...'")
+        if not line:
             continue
-            
-        original_input_course_from_llm = original_input_course_match.group(1).strip()
-        
-        ai_description = None
-        if ai_description_match:
-            desc_text = ai_description_match.group(1).strip()
-            if desc_text.lower() != "no ai description available.":
-                ai_description = desc_text
-        else: 
-            ai_description_standalone_match = re.search(r"AI Description:\s*(.*?)$", block_text, re.IGNORECASE | re.DOTALL)
-            if ai_description_standalone_match:
-                desc_text = ai_description_standalone_match.group(1).strip()
-                if desc_text.lower() != "no ai description available.":
-                    ai_description = desc_text
-            else:
-                 logging.warning(f"LLM Parser: Could not find 'AI Description' for Original Input '{original_input_course_from_llm}'. Block (first 300): '{block_text[:300]}...'")
-
-
-        current_suggestions = []
-        suggestions_text_match = re.search(r"Suggested Next Courses:\n(.*?)$", block_text, re.IGNORECASE | re.DOTALL)
-        
-        if suggestions_text_match:
-            suggestions_blob = suggestions_text_match.group(1).strip()
-            if suggestions_blob.lower() == "no specific suggestions available for this course.":
-                logging.info(f"LLM Parser: No specific suggestions for Original Input '{original_input_course_from_llm}'.")
-            else:
-                individual_suggestion_blocks = re.split(r'\n(?:-\s*)?Name:', suggestions_blob)
-                
-                for i, sug_block_part in enumerate(individual_suggestion_blocks):
-                    sug_block_part_cleaned = sug_block_part.strip()
-                    if i == 0 and not sug_block_part_cleaned : 
-                         if not suggestions_blob.strip().lower().startswith("name:"): 
-                            pass 
-                         else: 
-                            continue 
-                    
-                    full_sug_block = sug_block_part_cleaned
-                    if not sug_block_part_cleaned.lower().startswith("name:"):
-                        full_sug_block = "Name: " + sug_block_part_cleaned
-
-                    sug_name_match = re.search(r"Name:\s*(.*?)\n", full_sug_block, re.IGNORECASE)
-                    sug_desc_match = re.search(r"Description:\s*(.*?)\n", full_sug_block, re.IGNORECASE | re.DOTALL)
-                    sug_url_match = re.search(r"URL:\s*(https?://\S+)", full_sug_block, re.IGNORECASE)
-
-                    if sug_name_match and sug_desc_match and sug_url_match:
-                        current_suggestions.append({
-                            "name": sug_name_match.group(1).strip(),
-                            "description": sug_desc_match.group(1).strip(),
-                            "url": sug_url_match.group(1).strip()
-                        })
-                    else:
-                        logging.warning(f"LLM Parser: Could not parse full suggestion (name, desc, or URL missing) in block for Original Input '{original_input_course_from_llm}'. Suggestion block part (first 150 chars): '{full_sug_block[:150]}...'. Name_match: {bool(sug_name_match)}, Desc_match: {bool(sug_desc_match)}, URL_match: {bool(sug_url_match)}")
-        else:
-            logging.warning(f"LLM Parser: 'Suggested Next Courses:' section not found or malformed for Original Input '{original_input_course_from_llm}'. Block text (first 300 chars): '{block_text[:300]}...'")
-
-        parsed_results.append({
-            "original_input_course_from_llm": original_input_course_from_llm,
-            "ai_description": ai_description,
-            "llm_suggestions": current_suggestions
-        })
-        logging.info(f"LLM Parser: Parsed for Original Input '{original_input_course_from_llm}', AI Desc: {'Present' if ai_description else 'None'}, Suggestions: {len(current_suggestions)}")
-
+        if block is None:
+            block = {"original_input_course": None, "ai_description_lines": None, "saw_suggestions_header": False,
+                     "no_suggestions": False, "suggestions": [], "suggestion": None, "raw_lines": []}
+        block["raw_lines"].append(line)
+
+        field_match = _LLM_FIELD_PATTERN.match(line)
+        field = field_match.group(1).lower() if field_match else None
+        value = field_match.group(2).strip() if field_match else line
+
+        if field == "original input course" and block["original_input_course"] is None:
+            block["original_input_course"] = value
+            section = None
+        elif field == "ai description" and section != "suggestions":
+            block["ai_description_lines"] = [value]
+            section = "ai_description"
+        elif field == "suggested next courses":
+            block["saw_suggestions_header"] = True
+            section = "suggestions"
+        elif section == "ai_description" and field is None:
+            block["ai_description_lines"].append(value)
+        elif section == "suggestions":
+            if field == "name":
+                _finish_llm_suggestion(block["suggestion"], block["suggestions"], block["original_input_course"])
+                block["suggestion"] = {"name": value}
+            elif field == "description" and block["suggestion"] is not None and "description" not in block["suggestion"]:
+                block["suggestion"]["description"] = value
+            elif field == "url" and block["suggestion"] is not None and "url" not in block["suggestion"]:
+                url_match = _LLM_URL_PATTERN.match(value)
+                if url_match:
+                    block["suggestion"]["url"] = url_match.group(0)
+            elif line.lower() == "no specific suggestions available for this course.":
+                block["no_suggestions"] = True
+    _finish_llm_block(block, parsed_results)
+
+    logging.info(f"LLM Parser: Parsed {len(parsed_results)} identified course blocks.")
     return parsed_results
 
+def _course_match_key(course_name: str) -> str:
+    return course_name.replace(" [UNVERIFIED]", "").replace("¢", "").strip().lower()
+
 def generate_suggestions_from_known_courses(
     all_known_course_names_cleaned: List[str], 
-    cleaned_to_original_map: Dict[str, str],    
+    cleaned_to_original_map: Dict[str, List[str]],    
     previous_user_data_list: Optional[List[Dict]] = None,
     force_refresh_for_courses: Optional[List[str]] = None
 ):
@@ -500,30 +811,43 @@ def generate_suggestions_from_known_courses(
     logging.info(f"Suggestions Phase: Built cache map from previous data with {len(cached_data_map)} entries. Keys are original full names.")
 
     courses_to_query_cohere_for_batch_cleaned: List[str] = []
+    # Original names that still need LLM data, per cleaned name; several originals can share one cleaned name
+    # when they differ only in case, and each of them gets its own output item.
+    originals_to_query_by_cleaned_name: Dict[str, List[str]] = {}
+    force_refresh_set = {_course_match_key(course_name) for course_name in (force_refresh_for_courses or ())}
     
     for cleaned_course_name in all_known_course_names_cleaned:
-        original_full_name = cleaned_to_original_map.get(cleaned_course_name)
-        is_forced_refresh = force_refresh_for_courses and cleaned_course_name in force_refresh_for_courses
+        original_full_names = cleaned_to_original_map.get(cleaned_course_name)
+        is_forced_refresh = _course_match_key(cleaned_course_name) in force_refresh_set
 
-        if not original_full_name:
+        if not original_full_names:
             logging.warning(f"Suggestions Phase: Could not find original name for cleaned name '{cleaned_course_name}' during cache check. Will proceed to query LLM for cleaned name.")
             courses_to_query_cohere_for_batch_cleaned.append(cleaned_course_name)
+            originals_to_query_by_cleaned_name[cleaned_course_name] = [cleaned_course_name]
             continue
 
-        if original_full_name in cached_data_map and not is_forced_refresh:
-            logging.info(f"Suggestions Phase: Cache hit for original name '{original_full_name}' (via cleaned '{cleaned_course_name}'). Using cached data.")
-            user_processed_data_output.append({**cached_data_map[original_full_name], "processed_by": "Cache"})
-        else:
-            if is_forced_refresh: logging.info(f"Suggestions Phase: Force refresh requested for '{cleaned_course_name}' (original: '{original_full_name}'). Will query LLM.")
-            courses_to_query_cohere_for_batch_cleaned.append(cleaned_course_name) 
+        originals_to_query: List[str] = []
+        for original_full_name in original_full_names:
+            if original_full_name in cached_data_map and not is_forced_refresh:
+                logging.info(f"Suggestions Phase: Cache hit for original name '{original_full_name}' (via cleaned '{cleaned_course_name}'). Using cached data.")
+                user_processed_data_output.append({**cached_data_map[original_full_name], "processed_by": "Cache"})
+            else:
+                if is_forced_refresh: logging.info(f"Suggestions Phase: Force refresh requested for '{cleaned_course_name}' (original: '{original_full_name}'). Will query LLM.")
+                originals_to_query.append(original_full_name)
+        if originals_to_query:
+            courses_to_query_cohere_for_batch_cleaned.append(cleaned_course_name)
+            originals_to_query_by_cleaned_name[cleaned_course_name] = originals_to_query
     
     parsed_cohere_batch_items_map: Dict[str, Dict[str, any]] = {}
     if courses_to_query_cohere_for_batch_cleaned:
         logging.info(f"Suggestions Phase: Querying Cohere LLM (batch) for {len(courses_to_query_cohere_for_batch_cleaned)} cleaned courses: {courses_to_query_cohere_for_batch_cleaned}")
-        cohere_batch_response_data = query_llm_for_detailed_suggestions(courses_to_query_cohere_for_batch_cleaned)
+        cohere_batch_response_data = query_llm_for_detailed_suggestions(
+            courses_to_query_cohere_for_batch_cleaned,
+            bypass_cache=any(_course_match_key(course_name) in force_refresh_set for course_name in courses_to_query_cohere_for_batch_cleaned)
+        )
         
         if "text" in cohere_batch_response_data and cohere_batch_response_data["text"]:
-            parsed_cohere_batch_items = parse_llm_detailed_suggestions_response(cohere_batch_response_data["text"])
+            parsed_cohere_batch_items = cohere_batch_response_data["parsed"]
             parsed_cohere_batch_items_map = {
                 item["original_input_course_from_llm"].lower(): item 
                 for item in parsed_cohere_batch_items if "original_input_course_from_llm" in item
@@ -539,38 +863,57 @@ def generate_suggestions_from_known_courses(
             logging.error(f"Suggestions Phase (Cohere Batch): {llm_error_summary_for_output}")
 
     for cleaned_course_name_queried_in_batch in courses_to_query_cohere_for_batch_cleaned:
-        original_full_name_for_output = cleaned_to_original_map.get(cleaned_course_name_queried_in_batch, cleaned_course_name_queried_in_batch) 
         cohere_item_for_course = parsed_cohere_batch_items_map.get(cleaned_course_name_queried_in_batch.lower()) 
-
-        if cohere_item_for_course:
-            user_processed_data_output.append({
-                "identified_course_name": original_full_name_for_output, 
-                "description_from_graph": course_graph.get(cleaned_course_name_queried_in_batch, {}).get("description"), 
-                "ai_description": cohere_item_for_course.get("ai_description"),
-                "llm_suggestions": cohere_item_for_course.get("llm_suggestions", []),
-                "llm_error": None,
-                "processed_by": "Cohere (batch)"
-            })
-        else: 
-            error_msg_for_this_course = f"Cohere (batch): LLM was queried for '{cleaned_course_name_queried_in_batch}', but no specific data was returned or parsed for it in the batch response."
-            if llm_error_summary_for_output and "parsed" in llm_error_summary_for_output: 
-                error_msg_for_this_course = f"Cohere (batch): {llm_error_summary_for_output}"
-            elif llm_error_summary_for_output and "error" in llm_error_summary_for_output.lower():
-                 error_msg_for_this_course = llm_error_summary_for_output
-
-            logging.warning(f"No Cohere (batch) data for '{cleaned_course_name_queried_in_batch}' (original: '{original_full_name_for_output}'). Error: {error_msg_for_this_course}")
-            user_processed_data_output.append({
-                "identified_course_name": original_full_name_for_output,
-                "description_from_graph": course_graph.get(cleaned_course_name_queried_in_batch, {}).get("description"),
-                "ai_description": None,
-                "llm_suggestions": [],
-                "llm_error": error_msg_for_this_course,
-                "processed_by": "Cohere (batch failed)" 
-            })
+        for original_full_name_for_output in originals_to_query_by_cleaned_name[cleaned_course_name_queried_in_batch]:
+            if cohere_item_for_course:
+                user_processed_data_output.append({
+                    "identified_course_name": original_full_name_for_output, 
+                    "description_from_graph": course_graph.get(cleaned_course_name_queried_in_batch, {}).get("description"), 
+                    "ai_description": cohere_item_for_course.get("ai_description"),
+                    "llm_suggestions": cohere_item_for_course.get("llm_suggestions", []),
+                    "llm_error": None,
+                    "processed_by": "Cohere (batch)"
+                })
+            else: 
+                error_msg_for_this_course = f"Cohere (batch): LLM was queried for '{cleaned_course_name_queried_in_batch}', but no specific data was returned or parsed for it in the batch response."
+                if llm_error_summary_for_output and "parsed" in llm_error_summary_for_output: 
+                    error_msg_for_this_course = f"Cohere (batch): {llm_error_summary_for_output}"
+                elif llm_error_summary_for_output and "error" in llm_error_summary_for_output.lower():
+                     error_msg_for_this_course = llm_error_summary_for_output
+
+                logging.warning(f"No Cohere (batch) data for '{cleaned_course_name_queried_in_batch}' (original: '{original_full_name_for_output}'). Error: {error_msg_for_this_course}")
+                user_processed_data_output.append({
+                    "identified_course_name": original_full_name_for_output,
+                    "description_from_graph": course_graph.get(cleaned_course_name_queried_in_batch, {}).get("description"),
+                    "ai_description": None,
+                    "llm_suggestions": [],
+                    "llm_error": error_msg_for_this_course,
+                    "processed_by": "Cohere (batch failed)" 
+                })
     
     final_user_processed_data_after_fallback = []
     any_individual_fallback_errors = False
 
+    # Courses the batch call failed for are retried one per request; send those requests concurrently
+    # so the fallback costs roughly one round-trip instead of one per course.
+    # Keyed case-insensitively, so originals differing only in case share one request.
+    individual_fallback_course_names: Dict[str, str] = {}
+    for course_data_item in user_processed_data_output:
+        if course_data_item.get("processed_by") == "Cohere (batch failed)" and course_data_item.get("llm_error") is not None:
+            cleaned_name = course_data_item['identified_course_name'].replace(" [UNVERIFIED]", "").replace("¢", "").strip()
+            if cleaned_name:
+                individual_fallback_course_names.setdefault(cleaned_name.lower(), cleaned_name)
+    individual_fallback_responses: Dict[str, Dict[str, any]] = {}
+    if individual_fallback_course_names:
+        with ThreadPoolExecutor(max_workers=min(LLM_FALLBACK_CONCURRENCY, len(individual_fallback_course_names))) as fallback_pool:
+            individual_fallback_responses = dict(zip(
+                individual_fallback_course_names.keys(),
+                fallback_pool.map(
+                    lambda course_name: query_llm_for_detailed_suggestions([course_name], bypass_cache=_course_match_key(course_name) in force_refresh_set),
+                    individual_fallback_course_names.values()
+                )
+            ))
+
     for course_data_item in user_processed_data_output:
         is_cohere_batch_failure_for_item = course_data_item.get("processed_by") == "Cohere (batch failed)" and \
                                            course_data_item.get("llm_error") is not None
@@ -581,14 +924,14 @@ def generate_suggestions_from_known_courses(
         if is_cohere_batch_failure_for_item and cleaned_name_for_individual_query:
             logging.info(f"Suggestions Phase: Cohere (batch) failed for '{cleaned_name_for_individual_query}'. Attempting Cohere individual fallback. Batch error was: {course_data_item.get('llm_error')}")
             
-            cohere_individual_response = query_llm_for_detailed_suggestions([cleaned_name_for_individual_query])
+            cohere_individual_response = individual_fallback_responses[cleaned_name_for_individual_query.lower()]
             
             current_item_individual_error = None
             individual_ai_description = None
             individual_suggestions = []
             
             if "text" in cohere_individual_response and cohere_individual_response["text"]:
-                parsed_items = parse_llm_detailed_suggestions_response(cohere_individual_response["text"])
+                parsed_items = cohere_individual_response["parsed"]
                 if parsed_items and len(parsed_items) == 1:
                     parsed_individual_item = parsed_items[0]
                     if parsed_individual_item.get("original_input_course_from_llm", "").lower() == cleaned_name_for_individual_query.lower():
@@ -663,17 +1006,21 @@ def get_course_recommendations(
     if isinstance(known_course_names, list):
         consolidated_raw_names.extend(known_course_names)
 
-    unique_raw_names = sorted(list(set(filter(None, consolidated_raw_names))))
+    unique_raw_names = sorted(set(filter(None, consolidated_raw_names)))
 
     cleaned_names_for_llm_query: List[str] = []
-    cleaned_to_original_map: Dict[str, str] = {}
+    cleaned_to_original_map: Dict[str, List[str]] = {}
+    # Names differing only in case (e.g. "Python" and "python" from different pages) are queried once, under the
+    # first spelling seen; every original name is kept so each still gets its own result item.
+    query_name_by_lower: Dict[str, str] = {}
 
     for raw_name in unique_raw_names:
         cleaned_name = raw_name.replace(" [UNVERIFIED]", "").replace("¢", "").strip()
         if cleaned_name:
-            if cleaned_name not in cleaned_to_original_map:
+            if cleaned_name.lower() not in query_name_by_lower:
+                query_name_by_lower[cleaned_name.lower()] = cleaned_name
                 cleaned_names_for_llm_query.append(cleaned_name)
-                cleaned_to_original_map[cleaned_name] = raw_name
+            cleaned_to_original_map.setdefault(query_name_by_lower[cleaned_name.lower()], []).append(raw_name)
         elif raw_name:
             logging.warning(f"Suggestions Phase Init: Raw course name '{raw_name}' became empty after cleaning. It will be skipped for LLM suggestions.")
 
@@ -758,6 +1105,20 @@ if __name__ == "__main__":
         logging.warning(f"Blank test image '{blank_image_path}' not found. Extraction test skipped.")
 
 
+    print("\n--- Testing LLM Suggestions Parser (plain, numbered and markdown-emphasis formats) ---")
+    parser_check_inputs = {
+        "plain": "Original Input Course: Python\nAI Description: A language.\nSuggested Next Courses:\n- Name: Advanced Python\n  Description: Deeper topics.\n  URL: https://example.com/adv-python\n---",
+        "numbered": "1. Original Input Course: Python\n2. AI Description: A language.\n3. Suggested Next Courses:\n1. Name: Advanced Python\nDescription: Deeper topics.\nURL: https://example.com/adv-python\n---",
+        "bold": "**Original Input Course:** Python\n**AI Description:** A language.\n**Suggested Next Courses:**\n- **Name:** Advanced Python\n  **Description:** Deeper topics.\n  **URL:** https://example.com/adv-python\n---",
+    }
+    for format_name, sample_response in parser_check_inputs.items():
+        parsed_blocks = parse_llm_detailed_suggestions_response(sample_response)
+        parser_ok = (
+            len(parsed_blocks) == 1 and parsed_blocks[0]["original_input_course_from_llm"] == "Python"
+            and [s["name"] for s in parsed_blocks[0]["llm_suggestions"]] == ["Advanced Python"]
+        )
+        print(f"Parser check '{format_name}': {'OK' if parser_ok else 'FAILED'} -> {parsed_blocks}")
+
     print("\n--- Testing Suggestions Only Mode (using mocked course names) ---")
     known_courses_for_suggestions = ["Python Programming [UNVERIFIED]", "Typescript"]
     
@@ -780,7 +1141,13 @@ if __name__ == "__main__":
         force_refresh_for_courses=["Python Programming"] # Test force refresh
     )
     print("\nSuggestion Results (Local Test with Cohere individual fallback):")
-    print(json.dumps(suggestion_results, indent=2))
+    try:
+        import orjson
+        sys.stdout.flush()
+        sys.stdout.buffer.write(orjson.dumps(suggestion_results, option=orjson.OPT_INDENT_2) + b"\n")
+        sys.stdout.buffer.flush()
+    except ImportError:
+        print(json.dumps(suggestion_results, indent=2))
 
     if not COHERE_API_KEY:
         print("\nNOTE: Cohere API key not set. LLM calls were skipped in relevant tests.")